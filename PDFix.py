@@ -1,10 +1,47 @@
 import os
+import functools
+import mmap
+import multiprocessing
+import re
 import fitz  # PyMuPDF
 import shutil
-import tempfile
+import signal
 import sys
 import time
-from datetime import datetime
+import queue
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+
+# Functions called for every file, bound once so the lookups are not repeated
+_join = os.path.join
+_dirname = os.path.dirname
+_getsize = os.path.getsize
+_disk_usage = shutil.disk_usage
+_fitz_open = fitz.open
+
+# Name prefix of the temporary files written next to the PDFs being optimized
+_TEMP_PREFIX = ".temp_opt_"
+
+# Maximum number of PDFs from one directory handed to a worker process at once
+_MAX_BATCH_SIZE = 32
+
+# Time the scan may take to find more PDFs before the batches held back are handed out
+_HOLD_BACK_SECONDS = 0.1
+
+# Indirect object reference, like "12 0 R", in the source of a PDF object
+_OBJECT_REFERENCE = re.compile(r"\b(\d+) \d+ R\b")
+
+# Set by the main process when the run is aborted, see init_worker
+_stop_event = None
+
+# Contribution of a single file to the statistics returned by optimize_pdfs
+StatsDelta = namedtuple(
+    "StatsDelta",
+    "original_size_bytes optimized_size_bytes optimized_files skipped_files failed_files repaired_files",
+    defaults=(0, 0, 0, 0, 0, 0)
+)
 
 
 def optimize_pdfs(directory, compression_level=1, backup=False, size_threshold_mb=None, repair_mode=False):
@@ -29,8 +66,8 @@ def optimize_pdfs(directory, compression_level=1, backup=False, size_threshold_m
         "repaired_files": 0,
         "original_size_bytes": 0,
         "optimized_size_bytes": 0,
-        "start_time": datetime.now(),
     }
+    start_ns = time.perf_counter_ns()
 
     # Set compression parameters based on level
     compression_params = {
@@ -41,112 +78,556 @@ def optimize_pdfs(directory, compression_level=1, backup=False, size_threshold_m
 
     params = compression_params.get(compression_level, compression_params[1])
 
+    # The worker processes are started while the scanner threads are running, so
+    # they must not be forked from this process: they could inherit locks held
+    # by those threads, like the one of stdout
+    start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    mp_context = multiprocessing.get_context(start_method)
+
+    # Scan the directory tree in the background while the PDFs are being optimized
+    pdf_queue = queue.Queue(maxsize=1024)
+    stop_event = mp_context.Event()
+    scanner = threading.Thread(target=scan_pdfs, args=(directory, pdf_queue, stop_event), daemon=True)
+    scanner.start()
+
+    # Optimize the PDFs in parallel, in batches of files from the same directory
+    workers = os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+                                   initializer=init_worker, initargs=(stop_event,))
+    deltas = []
+    try:
+        futures = {}
+        for task in iter_pdf_tasks(pdf_queue, params, repair_mode, backup, size_threshold_mb, workers):
+            try:
+                futures[executor.submit(optimize_pdf_batch, task)] = task
+            except BrokenProcessPool as e:
+                deltas.extend(fail_pdf_batch(task, e))
+        for future in as_completed(futures):
+            try:
+                deltas.extend(future.result())
+            except BrokenProcessPool as e:
+                # A worker died, for example from a SIGBUS on a file truncated while
+                # it was mapped, which also stops the batches not done yet
+                deltas.extend(fail_pdf_batch(futures[future], e))
+    except BaseException:
+        # On Ctrl-C or an error, don't go on rewriting files: stop the scan and
+        # the workers, which only finish the file they are working on
+        stop_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        discard_queue(pdf_queue)
+        raise
+    executor.shutdown()
+
+    # Sum up the per-file results in one pass
+    stats["total_files"] = len(deltas)
+    stats.update(zip(StatsDelta._fields, map(sum, zip(*deltas))))
+
+    # Calculate overall statistics
+    stats["duration_ns"] = time.perf_counter_ns() - start_ns
+    if stats["original_size_bytes"] > 0:
+        stats["overall_reduction_percent"] = ((stats["original_size_bytes"] - stats["optimized_size_bytes"]) /
+                                              stats["original_size_bytes"] * 100)
+    else:
+        stats["overall_reduction_percent"] = 0
+
+    return stats
+
+
+def iter_pdf_tasks(pdf_queue, params, repair_mode, backup, size_threshold_mb, workers):
+    """
+    Yield optimization tasks for the PDFs put on the queue by scan_pdfs.
+
+    The PDFs of a directory go to one worker process as a single batch, only
+    directories with more than _MAX_BATCH_SIZE PDFs are spread over several.
+    The last batches are held back until the scan is done, so that they can
+    still be split up if there are fewer of them left than workers, for
+    example when all PDFs are in one folder. If the scan finds nothing new for
+    _HOLD_BACK_SECONDS, they are split up and handed out right away instead.
+
+    Args:
+        pdf_queue: Queue of per-directory PDF lists, terminated by None
+        params: Optimization parameters
+        repair_mode: Whether to attempt repairs on damaged PDFs
+        backup: Whether to create backups of original files
+        size_threshold_mb: Only optimize PDFs larger than this size (in MB)
+        workers: Number of worker processes
+
+    Yields:
+        tuple: Arguments for optimize_pdf_batch
+    """
     # Track processed files to handle potential file system race conditions
     processed_files = set()
+    pending = deque()
 
-    # Iterate through the directory and its subdirectories
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if not file.lower().endswith('.pdf'):
-                continue
+    # Consume PDFs until the scanner signals it is done
+    while True:
+        try:
+            pdf_files = pdf_queue.get(timeout=_HOLD_BACK_SECONDS)
+        except queue.Empty:
+            # Don't leave workers idle while a slow scan goes on
+            for pdf_files in split_batches(list(pending), workers):
+                yield pdf_files, params, repair_mode, backup, size_threshold_mb
+            pending.clear()
+            continue
+        if pdf_files is None:
+            break
 
-            pdf_path = os.path.join(root, file)
+        # Skip if already processed
+        pdf_files = [(pdf_path, file_size) for pdf_path, file_size in pdf_files if pdf_path not in processed_files]
+        processed_files.update(pdf_path for pdf_path, _ in pdf_files)
 
-            # Skip if already processed or temporary file
-            if pdf_path in processed_files or ".temp_optimized.pdf" in pdf_path:
-                continue
+        for start in range(0, len(pdf_files), _MAX_BATCH_SIZE):
+            pending.append(pdf_files[start:start + _MAX_BATCH_SIZE])
 
-            processed_files.add(pdf_path)
-            stats["total_files"] += 1
+        while len(pending) > workers:
+            yield pending.popleft(), params, repair_mode, backup, size_threshold_mb
 
-            try:
-                # Check if file exists and is accessible
-                if not os.path.exists(pdf_path) or not os.access(pdf_path, os.R_OK):
-                    print(f'Cannot access file: {pdf_path}')
-                    stats["failed_files"] += 1
-                    continue
-
-                # Get file size
-                try:
-                    file_size = os.path.getsize(pdf_path)
-                    file_size_mb = file_size / (1024 * 1024)
-                    stats["original_size_bytes"] += file_size
-                except OSError as e:
-                    print(f'Error getting size of {pdf_path}: {str(e)}')
-                    stats["failed_files"] += 1
-                    continue
-
-                # Check file size if threshold is set
-                if size_threshold_mb and file_size_mb < size_threshold_mb:
-                    print(f'Skipping {pdf_path} (size: {file_size_mb:.2f} MB, below threshold)')
-                    stats["skipped_files"] += 1
-                    stats["optimized_size_bytes"] += file_size  # No change for skipped files
-                    continue
-
-                # Check available disk space
-                try:
-                    disk_usage = shutil.disk_usage(os.path.dirname(pdf_path))
-                    if disk_usage.free < file_size * 2:  # Need at least 2x file size
-                        print(f'Skipping {pdf_path}: Not enough disk space')
-                        stats["skipped_files"] += 1
-                        stats["optimized_size_bytes"] += file_size
-                        continue
-                except Exception as e:
-                    print(f'Warning: Could not check disk space for {pdf_path}: {str(e)}')
-
-                # Create backup if requested
-                if backup:
-                    backup_path = pdf_path + '.backup'
+    for pdf_files in split_batches(list(pending), workers):
+        yield pdf_files, params, repair_mode, backup, size_threshold_mb
+
+
+def split_batches(batches, workers):
+    """
+    Split the largest batches in half until there is one for every worker.
+
+    Args:
+        batches: Lists of (pdf_path, file_size) tuples
+        workers: Number of worker processes
+
+    Returns:
+        list: The batches, split up where needed
+    """
+    while batches and len(batches) < workers:
+        largest = max(range(len(batches)), key=lambda i: len(batches[i]))
+        if len(batches[largest]) < 2:
+            break
+        pdf_files = batches.pop(largest)
+        middle = len(pdf_files) // 2
+        batches += [pdf_files[:middle], pdf_files[middle:]]
+    return batches
+
+
+def scan_pdfs(directory, pdf_queue, stop_event):
+    """
+    Find all PDFs in the given directory and its subdirectories and put them on a queue.
+
+    Each top-level subdirectory is walked by its own thread, so slow directory
+    listings overlap instead of running one after another.
+
+    Args:
+        directory: Directory to scan for PDFs
+        pdf_queue: Queue receiving the PDFs of each directory as a list of
+            (pdf_path, file_size) tuples, followed by None when done
+        stop_event: Event set when the run is aborted and the scan should stop early
+    """
+    try:
+        subdirs = []
+        queue_pdfs(iter_pdfs(directory, subdirs), pdf_queue, stop_event)
+
+        if subdirs and not stop_event.is_set():
+            with ThreadPoolExecutor(max_workers=min(8, len(subdirs))) as executor:
+                futures = [executor.submit(queue_pdfs, iter_pdfs(subdir), pdf_queue, stop_event)
+                           for subdir in subdirs]
+
+            # Report subtrees whose scan broke off, instead of silently leaving out their PDFs
+            for subdir, future in zip(subdirs, futures):
+                if future.exception() is not None:
+                    print(f'Error scanning {subdir}: {str(future.exception())}')
+    finally:
+        pdf_queue.put(None)
+
+
+def queue_pdfs(pdf_batches, pdf_queue, stop_event):
+    """Put the PDF lists found by iter_pdfs on the queue, until the scan is stopped."""
+    for pdf_files in pdf_batches:
+        if stop_event.is_set():
+            return
+        pdf_queue.put(pdf_files)
+
+
+def discard_queue(pdf_queue):
+    """Throw away everything on the queue, so scanner threads blocked on a full queue can finish."""
+    try:
+        while True:
+            pdf_queue.get_nowait()
+    except queue.Empty:
+        pass
+
+
+def iter_pdfs(root, subdirs=None):
+    """
+    Recursively find PDFs below a directory, skipping our own temporary files.
+
+    Symlinks to directories are neither followed nor mistaken for files.
+
+    Uses os.scandir so the directory entries returned by the listing are reused
+    for the type check and the file size, instead of stat-ing every path again.
+
+    Args:
+        root: Directory to scan
+        subdirs: If given, subdirectories are collected into this list instead of being scanned
+
+    Yields:
+        list: (pdf_path, file_size) tuples of the PDFs in one directory,
+            file_size is None if it could not be read
+    """
+    pdf_files = []
+    child_dirs = [] if subdirs is None else subdirs
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    child_dirs.append(entry.path)
+                elif (entry.name[-4:].lower() == '.pdf' and not entry.name.startswith(_TEMP_PREFIX)
+                      and entry.is_file()):
                     try:
-                        shutil.copy2(pdf_path, backup_path)
-                    except Exception as e:
-                        print(f'Warning: Could not create backup of {pdf_path}: {str(e)}')
-
-                # Optimize the PDF
-                result = optimize_pdf(pdf_path, params, repair_mode)
-                if result["success"]:
-                    stats["optimized_files"] += 1
-                    stats["optimized_size_bytes"] += result["new_size"]
-
-                    # Calculate and display size reduction
-                    original_size = result["original_size"]
-                    new_size = result["new_size"]
-                    reduction_percent = ((original_size - new_size) / original_size * 100) if original_size > 0 else 0
-
-                    print(f'Optimized: {pdf_path}')
-                    print(
-                        f'  Size: {original_size / 1024 / 1024:.2f} MB → {new_size / 1024 / 1024:.2f} MB ({reduction_percent:.1f}% reduction)')
-
-                    if result.get("repaired", False):
-                        stats["repaired_files"] += 1
-                        print(f'  Note: Repaired PDF structure before optimization')
-                else:
-                    stats["failed_files"] += 1
-                    stats["optimized_size_bytes"] += result["original_size"]  # No change in size for failed files
+                        file_size = entry.stat().st_size
+                    except OSError:
+                        file_size = None
+                    pdf_files.append((entry.path, file_size))
+    except OSError as e:
+        print(f'Cannot scan directory {root}: {str(e)}')
+
+    if pdf_files:
+        yield pdf_files
+
+    if subdirs is None:
+        for child_dir in child_dirs:
+            yield from iter_pdfs(child_dir)
+
+
+def optimize_pdf_batch(task):
+    """
+    Optimize a batch of PDFs from the same directory, one after another.
+
+    Runs in a worker process, so it has to stay a top-level function.
+
+    Args:
+        task: Tuple of (pdf_files, params, repair_mode, backup, size_threshold_mb),
+            pdf_files being a list of (pdf_path, file_size) tuples
+
+    Returns:
+        list: StatsDelta of every PDF in the batch
+    """
+    pdf_files, params, repair_mode, backup, size_threshold_mb = task
+    deltas = []
+    # Backups that cannot be hard-linked are copied on a single thread for the whole batch
+    with ThreadPoolExecutor(max_workers=1) as backup_executor:
+        for pdf_path, file_size in pdf_files:
+            # The run was aborted, leave the remaining files alone
+            if _stop_event is not None and _stop_event.is_set():
+                break
+            deltas.append(optimize_pdf_worker((pdf_path, file_size, params, repair_mode, backup, size_threshold_mb),
+                                              backup_executor))
+    return deltas
+
+
+def fail_pdf_batch(task, error):
+    """
+    Report every PDF of a batch as failed, after its worker process died.
+
+    The files of the batch count with their scanned size, as it is not known
+    which of them were optimized before.
+
+    Args:
+        task: Tuple of (pdf_files, params, repair_mode, backup, size_threshold_mb)
+        error: Exception the batch failed with
+
+    Returns:
+        list: StatsDelta of every PDF in the batch
+    """
+    deltas = []
+    for pdf_path, file_size in task[0]:
+        print(f'Error optimizing {pdf_path}: {str(error)}')
+        deltas.append(StatsDelta(original_size_bytes=file_size or 0, optimized_size_bytes=file_size or 0,
+                                 failed_files=1))
+    return deltas
+
+
+def init_worker(stop_event):
+    """
+    Set up a worker process.
+
+    Ctrl-C is left to the main process, so a file is never interrupted halfway.
+    The main process stops the workers through stop_event instead.
+    """
+    global _stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _stop_event = stop_event
+
+
+def optimize_pdf_worker(task, backup_executor=None):
+    """
+    Check, back up and optimize a single PDF found by the directory scan.
+
+    Args:
+        task: Tuple of (pdf_path, file_size, params, repair_mode, backup, size_threshold_mb)
+        backup_executor: Executor to copy the backup on while the PDF is optimized,
+            if None the copy is made before
+
+    Returns:
+        StatsDelta: Contribution of the file to the overall statistics
+    """
+    pdf_path, file_size, params, repair_mode, backup, size_threshold_mb = task
+    original_size = 0
+
+    try:
+        # Get file size, unless the directory scan already provided it
+        try:
+            if file_size is None:
+                file_size = _getsize(pdf_path)
+            file_size_mb = file_size / (1024 * 1024)
+            original_size = file_size
+        except OSError as e:
+            print(f'Error getting size of {pdf_path}: {str(e)}')
+            return StatsDelta(failed_files=1)
+
+        # Check file size if threshold is set, before spending any syscalls on the file
+        if size_threshold_mb and file_size_mb < size_threshold_mb:
+            print(f'Skipping {pdf_path} (size: {file_size_mb:.2f} MB, below threshold)')
+            # No change for skipped files
+            return StatsDelta(original_size_bytes=file_size, optimized_size_bytes=file_size, skipped_files=1)
+
+        # Check if file exists and is accessible (access fails for missing files too)
+        if not os.access(pdf_path, os.R_OK):
+            print(f'Cannot access file: {pdf_path}')
+            return StatsDelta(failed_files=1)
+
+        # Check available disk space
+        try:
+            if free_disk_space(_dirname(pdf_path)) < file_size * 2:  # Need at least 2x file size
+                print(f'Skipping {pdf_path}: Not enough disk space')
+                return StatsDelta(original_size_bytes=file_size, optimized_size_bytes=file_size, skipped_files=1)
+        except Exception as e:
+            print(f'Warning: Could not check disk space for {pdf_path}: {str(e)}')
+
+        # Create backup if requested, a copy is finished in the background while the PDF is optimized
+        backup_future = None
+        backup_error = None
+        if backup:
+            try:
+                backup_future = create_backup(pdf_path, pdf_path + '.backup', backup_executor)
             except Exception as e:
-                print(f'Unexpected error processing {pdf_path}: {str(e)}')
-                stats["failed_files"] += 1
-                # Try to add the file size to stats if possible
-                try:
-                    if os.path.exists(pdf_path):
-                        file_size = os.path.getsize(pdf_path)
-                        stats["optimized_size_bytes"] += file_size
-                except:
-                    pass
+                backup_error = e
 
-    # Calculate overall statistics
-    stats["end_time"] = datetime.now()
-    stats["duration"] = stats["end_time"] - stats["start_time"]
-    if stats["original_size_bytes"] > 0:
-        stats["overall_reduction_percent"] = ((stats["original_size_bytes"] - stats["optimized_size_bytes"]) /
-                                              stats["original_size_bytes"] * 100)
-    else:
-        stats["overall_reduction_percent"] = 0
+        # Optimize the PDF
+        result = optimize_pdf(pdf_path, params, repair_mode, file_size, backup_future)
 
-    return stats
+        if backup and backup_error is None:
+            try:
+                if backup_future is not None:
+                    backup_future.result()
+                detach_backup(pdf_path, pdf_path + '.backup')
+            except Exception as e:
+                backup_error = e
+        if backup_error is not None:
+            print(f'Warning: Could not create backup of {pdf_path}: {str(backup_error)}')
+
+        if not result["success"]:
+            # No change in size for failed files
+            return StatsDelta(original_size_bytes=file_size, optimized_size_bytes=result["original_size"],
+                              failed_files=1)
+
+        if result["skipped"]:
+            # No change for files that were left alone
+            return StatsDelta(original_size_bytes=file_size, optimized_size_bytes=file_size, skipped_files=1)
+
+        # Calculate and display size reduction
+        new_size = result["new_size"]
+        reduction_percent = ((original_size - new_size) / original_size * 100) if original_size > 0 else 0
+
+        print(f'Optimized: {pdf_path}')
+        print(
+            f'  Size: {original_size / 1024 / 1024:.2f} MB → {new_size / 1024 / 1024:.2f} MB ({reduction_percent:.1f}% reduction)')
+
+        repaired = result.get("repaired", False)
+        if repaired:
+            print(f'  Note: Repaired PDF structure before optimization')
+
+        return StatsDelta(original_size_bytes=file_size, optimized_size_bytes=new_size, optimized_files=1,
+                          repaired_files=int(repaired))
+    except Exception as e:
+        print(f'Unexpected error processing {pdf_path}: {str(e)}')
+        # Try to add the file size to stats if possible
+        current_size = 0
+        try:
+            if os.path.exists(pdf_path):
+                current_size = os.path.getsize(pdf_path)
+        except:
+            pass
+        return StatsDelta(original_size_bytes=original_size, optimized_size_bytes=current_size, failed_files=1)
+
+
+def create_backup(pdf_path, backup_path, executor=None):
+    """
+    Back up a PDF before it is optimized.
+
+    The optimized file replaces the original through a rename, never by writing
+    into it, so a hard link keeps the original contents without copying them.
+    If the original ends up being kept, detach_backup turns the link into a copy.
+    Where hard links are not possible, the file is copied instead, on executor
+    if one is given.
+
+    Returns:
+        Future: The copy still in progress, or None if the backup is complete
+    """
+    try:
+        os.link(pdf_path, backup_path)
+    except OSError:
+        if executor is not None:
+            return executor.submit(copy_backup, pdf_path, backup_path)
+        copy_backup(pdf_path, backup_path)
+    return None
+
+
+def copy_backup(pdf_path, backup_path):
+    """
+    Copy a PDF to its backup.
+
+    Uses shutil.copyfile, which copies in-kernel where available, and only
+    carries over the timestamps instead of the full metadata copied by shutil.copy2.
+    """
+    st = os.stat(pdf_path)
+    shutil.copyfile(pdf_path, backup_path)
+    os.utime(backup_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def detach_backup(pdf_path, backup_path):
+    """
+    Replace a backup that is still a hard link to the PDF with a copy.
+
+    Happens when the original was kept, for example without size reduction or on
+    errors. Otherwise any later in-place edit of the PDF would change the backup too.
+    """
+    if os.path.samefile(pdf_path, backup_path):
+        os.remove(backup_path)
+        copy_backup(pdf_path, backup_path)
+
+
+@functools.lru_cache(maxsize=128)
+def free_disk_space(directory):
+    """
+    Return the free disk space for a directory in bytes.
+
+    Cached per directory, as free space changes slowly compared to how fast
+    the PDFs of one directory are processed.
+    """
+    return _disk_usage(directory).free
+
+
+def has_pdf_header(pdf_path):
+    """
+    Check whether a file starts like a PDF.
+
+    Only the first 1024 bytes are searched for the %PDF- header. MuPDF also
+    opens files with more junk in front of it, so this is only a quick filter
+    for files that are not PDFs at all, not a validity check. A missing %%EOF
+    trailer is not checked either, as truncated files can often still be
+    opened or repaired by MuPDF.
+    """
+    fd = os.open(pdf_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        return b'%PDF-' in os.read(fd, 1024)
+    finally:
+        os.close(fd)
+
+
+def is_fully_compressed(pdf_document):
+    """
+    Check whether saving a PDF with garbage collection and deflate can still shrink it.
+
+    That is not the case if all streams are already compressed and the objects
+    are packed into object streams with a cross-reference stream, which MuPDF
+    does not write itself. Garbage collection must not have anything to do
+    either: every object has to be reachable from the trailer, with no free
+    entries left by deleted objects and no duplicates to merge. Files with
+    incremental updates are not considered compressed for the same reason.
+
+    Args:
+        pdf_document: Opened PDF document
+
+    Returns:
+        bool: True if the PDF is already fully compressed
+    """
+    if pdf_document.xref_get_key(-1, "Type") != ("name", "/XRef"):
+        return False
+    if pdf_document.xref_get_key(-1, "Prev")[0] != "null":
+        return False
+
+    xref_length = pdf_document.xref_length()
+    reachable = set()
+    seen_objects = set()
+    pending = [int(xref) for xref in _OBJECT_REFERENCE.findall(pdf_document.xref_object(-1, compressed=True))]
+    while pending:
+        xref = pending.pop()
+        if xref in reachable or not 0 < xref < xref_length:
+            continue
+        reachable.add(xref)
+
+        source = pdf_document.xref_object(xref, compressed=True)
+        stream_hash = None
+        if pdf_document.xref_is_stream(xref):
+            if pdf_document.xref_get_key(xref, "Filter")[0] == "null":
+                return False
+            stream_hash = hash(pdf_document.xref_stream_raw(xref))
+
+        # A hash collision only costs a rewrite that was not needed
+        if (source, stream_hash) in seen_objects:
+            return False
+        seen_objects.add((source, stream_hash))
+        pending.extend(int(ref) for ref in _OBJECT_REFERENCE.findall(source))
+
+    # Only the object streams and the cross-reference stream are not referenced by other objects
+    for xref in range(1, xref_length):
+        if xref not in reachable and pdf_document.xref_get_key(xref, "Type")[1] not in ("/ObjStm", "/XRef"):
+            return False
+
+    return True
+
+
+def open_pdf_mapped(pdf_path):
+    """
+    Open a PDF with MuPDF reading from a read-only memory map of the file.
 
+    MuPDF then reads the file straight from the page cache, instead of copying
+    it into its own buffers through read() calls. Falls back to opening the file
+    normally where it cannot be mapped.
 
-def optimize_pdf(pdf_path, params, repair_mode=False):
+    Args:
+        pdf_path: Path to the PDF file
+
+    Returns:
+        tuple: (pdf_document, close), where close() closes the document and unmaps the file
+    """
+    fd = os.open(pdf_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        pdf_document = _fitz_open(pdf_path)
+        return pdf_document, pdf_document.close
+    finally:
+        os.close(fd)
+
+    view = memoryview(mapping)
+    try:
+        pdf_document = _fitz_open(stream=view, filetype="pdf")
+    except Exception:
+        view.release()
+        mapping.close()
+        raise
+
+    def close():
+        # The mapping can only be closed once MuPDF no longer uses the view on it
+        try:
+            pdf_document.close()
+        finally:
+            view.release()
+            mapping.close()
+
+    return pdf_document, close
+
+
+def optimize_pdf(pdf_path, params, repair_mode=False, original_size=None, backup_future=None):
     """
     Optimize a single PDF file.
 
@@ -154,28 +635,38 @@ def optimize_pdf(pdf_path, params, repair_mode=False):
         pdf_path: Path to the PDF file
         params: Optimization parameters
         repair_mode: Whether to attempt repair of damaged PDFs
+        original_size: Size of the PDF in bytes, if already known
+        backup_future: Future of a backup still being created, the original file
+            is not replaced before it is done
 
     Returns:
         dict: Result of the optimization
     """
-    original_size = os.path.getsize(pdf_path)
+    if original_size is None:
+        original_size = _getsize(pdf_path)
     result = {
         "success": False,
         "original_size": original_size,
         "new_size": original_size,
         "error": None,
-        "repaired": False
+        "repaired": False,
+        "skipped": False
     }
 
     # Generate a unique filename for the temporary file
-    temp_dir = os.path.dirname(pdf_path)
-    temp_filename = f".temp_opt_{os.path.basename(pdf_path)}_{os.getpid()}_{int(time.time())}.pdf"
-    temp_optimized_pdf_path = os.path.join(temp_dir, temp_filename)
+    temp_dir = _dirname(pdf_path)
+    temp_filename = f"{_TEMP_PREFIX}{os.path.basename(pdf_path)}_{os.getpid()}_{int(time.time())}.pdf"
+    temp_optimized_pdf_path = _join(temp_dir, temp_filename)
 
     try:
+        # Reject files that are not PDFs at all before MuPDF spends time parsing them,
+        # unless MuPDF is asked to recover what it can from them
+        if not repair_mode and not has_pdf_header(pdf_path):
+            raise Exception("File does not have a PDF header")
+
         # Try to open the PDF using PyMuPDF
         try:
-            pdf_document = fitz.open(pdf_path)
+            pdf_document, close_document = open_pdf_mapped(pdf_path)
         except Exception as e:
             if not repair_mode:
                 raise e
@@ -183,14 +674,15 @@ def optimize_pdf(pdf_path, params, repair_mode=False):
             # Special handling for damaged PDFs
             print(f'Attempting to repair damaged PDF: {pdf_path}')
             result["repaired"] = True
-            pdf_document = page_by_page_recovery(pdf_path)
+            pdf_document = recover_to_doc(pdf_path)
             if not pdf_document:
                 raise Exception("PDF repair failed")
+            close_document = pdf_document.close
 
         # Skip password-protected documents
         if pdf_document.is_encrypted:
             print(f'Skipping encrypted PDF: {pdf_path}')
-            pdf_document.close()
+            close_document()
             result["error"] = "PDF is encrypted"
             return result
 
@@ -198,6 +690,14 @@ def optimize_pdf(pdf_path, params, repair_mode=False):
         if not pdf_document.can_save_incrementally():
             print(f'Warning: {pdf_path} may not support all optimizations')
 
+        # Skip the expensive rewrite if it cannot make the file any smaller
+        if params["garbage"] <= 3 and not pdf_document.is_repaired and is_fully_compressed(pdf_document):
+            print(f'  Already compressed: {pdf_path}, keeping original')
+            close_document()
+            result["success"] = True
+            result["skipped"] = True
+            return result
+
         try:
             # Try standard optimization
             pdf_document.save(
@@ -217,7 +717,7 @@ def optimize_pdf(pdf_path, params, repair_mode=False):
                 # Use more conservative parameters
                 pdf_document.save(
                     temp_optimized_pdf_path,
-                    incremental=True,  # Less aggressive
+                    incremental=False,  # Incremental saves only work onto the original file
                     garbage=1,  # Minimal garbage collection
                     deflate=True,  # Still compress
                     clean=False  # Skip cleaning step
@@ -226,30 +726,35 @@ def optimize_pdf(pdf_path, params, repair_mode=False):
             except Exception:
                 # Last resort: try copying page by page to a new document
                 print(f'Attempting page-by-page reconstruction for: {pdf_path}')
-                pdf_document.close()  # Close document before trying page-by-page recovery
-                if page_by_page_recovery(pdf_path, temp_optimized_pdf_path):
+                close_document()  # Close document before trying page-by-page recovery
+                if recover_to_file(pdf_path, temp_optimized_pdf_path):
                     result["repaired"] = True
                 else:
                     raise Exception("Could not repair PDF even with page-by-page method")
 
         # Make sure the document is closed
         try:
-            pdf_document.close()
+            close_document()
         except:
             pass
 
         # Verify the temporary file exists before proceeding
-        if not os.path.exists(temp_optimized_pdf_path):
+        try:
+            new_size = os.stat(temp_optimized_pdf_path).st_size
+        except FileNotFoundError:
             raise Exception(f"Temporary optimized file was not created: {temp_optimized_pdf_path}")
 
         # Check if optimization actually reduced the size
-        new_size = os.path.getsize(temp_optimized_pdf_path)
 
         if new_size < original_size:
             # Replace the original PDF with the optimized one
             try:
-                # Use safer approach to replace the file
-                shutil.move(temp_optimized_pdf_path, pdf_path)
+                # Keep the original in place until its backup is complete
+                if backup_future is not None:
+                    wait((backup_future,))
+
+                # The temporary file is in the same directory, so this is an atomic rename
+                os.replace(temp_optimized_pdf_path, pdf_path)
                 result["success"] = True
                 result["new_size"] = new_size
             except Exception as e:
@@ -259,6 +764,7 @@ def optimize_pdf(pdf_path, params, repair_mode=False):
             os.remove(temp_optimized_pdf_path)
             print(f'  No size reduction for {pdf_path}, keeping original')
             result["success"] = True  # Still mark as success since processing completed
+            result["repaired"] = False  # The repaired copy was discarded
 
     except Exception as e:
         error_msg = str(e)
@@ -273,72 +779,54 @@ def optimize_pdf(pdf_path, params, repair_mode=False):
 
         # Cleanup temp file if it exists
         try:
-            if os.path.exists(temp_optimized_pdf_path):
-                os.remove(temp_optimized_pdf_path)
+            os.remove(temp_optimized_pdf_path)
+        except FileNotFoundError:
+            pass
         except Exception as cleanup_error:
             print(f'  Warning: Could not remove temporary file: {str(cleanup_error)}')
 
     return result
 
 
-def attempt_pdf_repair(pdf_path):
+def copy_pages(src_doc):
     """
-    Attempt to repair a damaged PDF file.
+    Copy the pages of a document into a new one, skipping pages that cannot be copied.
 
     Args:
-        pdf_path: Path to the PDF file
+        src_doc: Document to copy the pages from
 
     Returns:
-        fitz.Document or None: Repaired document or None if repair failed
+        fitz.Document: New document holding the copied pages
     """
+    # Copy all pages in one go
+    new_doc = fitz.open()
     try:
-        # First try opening normally
-        pdf_document = fitz.open(pdf_path)
-        if pdf_document.is_pdf and pdf_document.page_count > 0:
-            return pdf_document
-        pdf_document.close()
-    except:
-        pass
-
-    # If that fails, try a more aggressive approach
-    try:
-        # Create a temporary file for the repaired PDF
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-        temp_file.close()
-
-        # Try to use a basic approach without special parameters
-        pdf_document = fitz.open()
-        source_doc = fitz.open(pdf_path)  # No repair parameter
-        pdf_document.insert_pdf(source_doc)  # No garbage parameter
-        source_doc.close()
-
-        pdf_document.save(temp_file.name)
-        pdf_document.close()
-
-        # Try to open the repaired PDF
-        repaired_doc = fitz.open(temp_file.name)
-        if repaired_doc.page_count > 0:
-            # Copy the repaired file back to original path
-            temp_repaired = pdf_path + '.repaired.pdf'
-            shutil.copy2(temp_file.name, temp_repaired)
-            os.replace(temp_repaired, pdf_path)
-            os.unlink(temp_file.name)
-            # Re-open the repaired file
-            return fitz.open(pdf_path)
-    except:
-        # Clean up temp file if it exists
-        if os.path.exists(temp_file.name):
-            try:
-                os.unlink(temp_file.name)
-            except:
-                pass
+        new_doc.insert_pdf(src_doc)
+        return new_doc
+    except Exception:
+        new_doc.close()
+
+    # Copy pages one by one, skipping problematic ones. Keeping the object map
+    # between calls (final=False) avoids copying shared resources like fonts
+    # again for every page.
+    new_doc = fitz.open()
+    last_page = src_doc.page_count - 1
+    for page_num in range(src_doc.page_count):
+        try:
+            new_doc.insert_pdf(src_doc, from_page=page_num, to_page=page_num,
+                               final=page_num == last_page)
+        except:
+            print(f"Skipping problematic page {page_num}")
+            continue
 
-    return None
+    return new_doc
 
 
-def page_by_page_recovery(pdf_path):
+def recover_to_doc(pdf_path):
     """
-    Attempt to repair a damaged PDF file.
+    Attempt to repair a damaged PDF file by rebuilding it in memory.
+
+    The original file is left untouched.
 
     Args:
         pdf_path: Path to the PDF file
@@ -347,75 +835,49 @@ def page_by_page_recovery(pdf_path):
         fitz.Document or None: Repaired document or None if repair failed
     """
     try:
-        # First try opening normally
-        pdf_document = fitz.open(pdf_path)
-        if pdf_document.is_pdf and pdf_document.page_count > 0:
-            return pdf_document
-        pdf_document.close()
+        src_doc = fitz.open(pdf_path)
     except Exception as e:
-        print(f"Initial open failed: {e}")
-        pass
+        print(f"Page-by-page recovery failed: {e}")
+        return None
 
-    # If that fails, try a more aggressive approach
     try:
-        # Create a temporary file for the repaired PDF
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-        temp_file.close()
+        new_doc = copy_pages(src_doc)
+    except Exception as e:
+        print(f"Page-by-page recovery failed: {e}")
+        return None
+    finally:
+        src_doc.close()
 
-        # Try to use a simpler approach - just copy pages one by one
-        src_doc = None
-        try:
-            # Try to open the source document
-            src_doc = fitz.open(pdf_path)
+    if new_doc.page_count > 0:
+        return new_doc
 
-            # Create a new document
-            new_doc = fitz.open()
+    new_doc.close()
+    return None
 
-            # Copy pages one by one, skipping problematic ones
-            for page_num in range(src_doc.page_count):
-                try:
-                    new_doc.insert_pdf(src_doc, from_page=page_num, to_page=page_num)
-                except:
-                    print(f"Skipping problematic page {page_num}")
-                    continue
 
-            # Save the repaired document
-            new_doc.save(temp_file.name)
-            new_doc.close()
+def recover_to_file(src_path, dst_path):
+    """
+    Attempt to repair a damaged PDF file by rebuilding it into another file.
 
-        except Exception as e:
-            print(f"Page-by-page recovery failed: {e}")
-            if src_doc:
-                src_doc.close()
-            raise
-        finally:
-            if src_doc:
-                src_doc.close()
-
-        # Try to open the repaired PDF
-        repaired_doc = fitz.open(temp_file.name)
-        if repaired_doc.page_count > 0:
-            # Copy the repaired file back to original path
-            temp_repaired = pdf_path + '.repaired.pdf'
-            shutil.copy2(temp_file.name, temp_repaired)
-            os.replace(temp_repaired, pdf_path)
-            repaired_doc.close()
-            # Re-open the repaired file
-            return fitz.open(pdf_path)
-        else:
-            repaired_doc.close()
+    Args:
+        src_path: Path to the damaged PDF file
+        dst_path: Path to write the repaired PDF to
 
+    Returns:
+        bool: Whether a repaired PDF with at least one page was written
+    """
+    new_doc = recover_to_doc(src_path)
+    if not new_doc:
+        return False
+
+    try:
+        new_doc.save(dst_path, garbage=1, deflate=True)
+        return True
     except Exception as e:
         print(f"Recovery attempt failed: {e}")
+        return False
     finally:
-        # Clean up temp file if it exists
-        if os.path.exists(temp_file.name):
-            try:
-                os.unlink(temp_file.name)
-            except:
-                pass
-
-    return None
+        new_doc.close()
 
 
 def print_summary(stats):
@@ -437,7 +899,7 @@ def print_summary(stats):
     print(f"\nOriginal size: {original_size_mb:.2f} MB")
     print(f"Optimized size: {optimized_size_mb:.2f} MB")
     print(f"Space saved: {saved_mb:.2f} MB ({stats['overall_reduction_percent']:.1f}%)")
-    print(f"\nTime taken: {stats['duration']}")
+    print(f"\nTime taken: {stats['duration_ns'] / 1e9:.2f} seconds")
     print("=" * 50)
 
 